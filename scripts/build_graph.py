@@ -10,183 +10,638 @@ Usage:
     python build_graph.py ../data/quotes.jsonl ../data/neighbors.json --k 10 --model all-MiniLM-L6-v2
 
 Requirements:
-    pip install sentence-transformers numpy scikit-learn
+    pip install sentence-transformers numpy
+
+Optional:
+    pip install faiss-cpu    # approximate nearest neighbor search for large corpora
+    pip install orjson       # faster JSON loading and saving
+    pip install numba        # JIT-compiled top-k selection for the exact search
+    pip install scipy        # sparse term-document matrix for the lexical index
+    pip install sentence-transformers[onnx]    # faster CPU inference via ONNX Runtime
 """
 
 import json
+import hashlib
+import re
 import argparse
 import numpy as np
 from pathlib import Path
-from typing import List, Dict, Tuple
+from typing import List, Dict, NamedTuple, Optional, Tuple
 import logging
 
 try:
+    import torch
     from sentence_transformers import SentenceTransformer
-    from sklearn.metrics.pairwise import cosine_similarity
     DEPENDENCIES_AVAILABLE = True
 except ImportError:
     DEPENDENCIES_AVAILABLE = False
 
+try:
+    import faiss
+    FAISS_AVAILABLE = True
+except ImportError:
+    FAISS_AVAILABLE = False
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+try:
+    from scipy import sparse
+    SCIPY_AVAILABLE = True
+except ImportError:
+    SCIPY_AVAILABLE = False
+
+try:
+    import onnxruntime
+    ONNX_AVAILABLE = True
+except ImportError:
+    ONNX_AVAILABLE = False
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Below this many quotes an exact inner-product search beats the cost of
+# building an HNSW graph.
+HNSW_MIN_QUOTES = 10000
+
+# Rows of the similarity matrix computed at a time by the exact search
+SIMILARITY_BLOCK_SIZE = 4096
+
+# Rows of the similarity matrix computed at a time on the GPU
+GPU_BLOCK_SIZE = 8192
+
+# Dynamically int8-quantized export shipped alongside the ONNX model, tuned
+# for CPUs with AVX-512 VNNI dot-product instructions
+QUANTIZED_ONNX_FILE = 'onnx/model_qint8_avx512_vnni.onnx'
+
+# Embedding cache key suffix per inference backend; backends produce
+# slightly different vectors, so their cached embeddings must not mix
+_BACKEND_CACHE_TAGS = {'torch': '', 'onnx': '|onnx', 'onnx-int8': '|int8'}
+
+# Lexical index tokens: 4+ character words from quote text, 3+ character
+# words from author and book title
+_WORD4 = re.compile(r'\b\w{4,}\b')
+_WORD3 = re.compile(r'\b\w{3,}\b')
+
+
+class QuoteColumns(NamedTuple):
+    """Quote fields as parallel lists, one entry per quote in corpus order."""
+    ids: List[str]
+    texts: List[str]
+    authors: List[str]
+    books: List[str]
+
+
+def _columnize(quotes: List[Dict]) -> QuoteColumns:
+    """Convert quote dicts to columns once, so later passes skip dict lookups."""
+    return QuoteColumns(
+        ids=[quote['id'] for quote in quotes],
+        texts=[quote['text'] for quote in quotes],
+        authors=[quote.get('author') or '' for quote in quotes],
+        books=[quote.get('book_title') or '' for quote in quotes]
+    )
+
+
+if NUMBA_AVAILABLE:
+    @njit(parallel=True, cache=True)
+    def _topk_rows(sims, k):
+        """Indices of the k largest entries of each row, in descending order."""
+        n_rows, n_cols = sims.shape
+        out = np.empty((n_rows, k), dtype=np.int32)
+        
+        for r in prange(n_rows):
+            # Sorted insertion into a k-slot buffer; most entries fail the
+            # first comparison, so this is one pass over the row
+            best = np.empty(k, dtype=sims.dtype)
+            best[:] = -np.inf
+            idx = np.zeros(k, dtype=np.int32)
+            
+            for c in range(n_cols):
+                v = sims[r, c]
+                if v > best[k - 1]:
+                    j = k - 1
+                    while j > 0 and best[j - 1] < v:
+                        best[j] = best[j - 1]
+                        idx[j] = idx[j - 1]
+                        j -= 1
+                    best[j] = v
+                    idx[j] = c
+            
+            out[r] = idx
+        
+        return out
+
+
+def _write_json(data, path, pretty: bool = False):
+    """Write data as UTF-8 JSON, compact unless pretty is set."""
+    if ORJSON_AVAILABLE:
+        # Non-string keys (e.g. integer quote IDs) are stringified, as json.dump does
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if pretty else 0)
+        with open(path, 'wb') as f:
+            f.write(orjson.dumps(data, option=option))
+    else:
+        # Without indent, json.dump stays on the C encoder fast path
+        with open(path, 'w', encoding='utf-8') as f:
+            if pretty:
+                json.dump(data, f, indent=2, ensure_ascii=False)
+            else:
+                json.dump(data, f, separators=(',', ':'), ensure_ascii=False)
+
 
 class GraphBuilder:
-    def __init__(self, model_name: str = 'all-MiniLM-L6-v2', k: int = 10):
+    def __init__(self, model_name: str = 'all-MiniLM-L6-v2', k: int = 10, quantize: bool = False,
+                 batch_size: Optional[int] = None, compile_model: bool = False):
         """
         Initialize the graph builder.
         
         Args:
             model_name: Name of the sentence transformer model to use
             k: Number of nearest neighbors to find for each quote
+            quantize: Use int8-quantized ONNX weights when running on CPU
+            batch_size: Texts per encode batch (default: 256 on GPU, 64 on CPU)
+            compile_model: Compile the transformer with torch.compile on a single GPU
         """
         self.model_name = model_name
         self.k = k
+        self.compile_model = compile_model
         self.model = None
         
         if not DEPENDENCIES_AVAILABLE:
             raise ImportError(
                 "Required dependencies not found. Please install:\n"
-                "pip install sentence-transformers numpy scikit-learn"
+                "pip install sentence-transformers numpy"
             )
+        
+        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        
+        onnx_usable = ONNX_AVAILABLE and self.device == 'cpu'
+        if quantize and not onnx_usable:
+            logger.warning("Quantization needs onnxruntime and a CPU device; "
+                           "using full-precision weights")
+            quantize = False
+        self.quantize = quantize
+        
+        # Backend the model is expected to load on; load_model records the
+        # one it actually got, which cache keys are derived from
+        self.backend = ('onnx-int8' if quantize else 'onnx') if onnx_usable else 'torch'
+        # Larger batches only pay off when the GPU can run them in parallel
+        if batch_size is None:
+            batch_size = 256 if self.device == 'cuda' else 64
+        self.batch_size = batch_size
     
     def load_model(self):
         """Load the sentence transformer model."""
-        logger.info(f"Loading model: {self.model_name}")
-        self.model = SentenceTransformer(self.model_name)
+        logger.info(f"Loading model: {self.model_name} (device: {self.device})")
+        self.model = self._try_load_onnx()
+        if self.model is None:
+            self.backend = 'torch'
+            self.model = SentenceTransformer(self.model_name, device=self.device)
+            
+            if self.compile_model and torch.cuda.device_count() == 1 and hasattr(torch, 'compile'):
+                # Fuse the transformer layers' kernels; compiled on first encode
+                logger.info("Compiling model with torch.compile...")
+                self.model[0].auto_model = torch.compile(self.model[0].auto_model, mode='max-autotune')
         logger.info("Model loaded successfully")
     
+    def _try_load_onnx(self):
+        """Load the model on the ONNX Runtime CPU backend, or return None."""
+        if not ONNX_AVAILABLE or self.device != 'cpu':
+            return None
+        
+        session_options = onnxruntime.SessionOptions()
+        session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        
+        model_kwargs = {
+            'provider': 'CPUExecutionProvider',
+            'session_options': session_options
+        }
+        if self.quantize:
+            model_kwargs['file_name'] = QUANTIZED_ONNX_FILE
+        
+        try:
+            model = SentenceTransformer(
+                self.model_name,
+                device='cpu',
+                backend='onnx',
+                model_kwargs=model_kwargs
+            )
+        except Exception as e:
+            # Older sentence-transformers without backends, missing optimum,
+            # or a model without an ONNX export
+            logger.warning(f"ONNX backend unavailable, falling back to PyTorch: {e}")
+            if self.quantize:
+                logger.warning("Quantization not applied; using full-precision weights")
+                self.quantize = False
+            return None
+        
+        logger.info("Using ONNX Runtime backend" + (" (int8 quantized)" if self.quantize else ""))
+        return model
+    
     def load_quotes(self, quotes_path: str) -> List[Dict]:
         """Load quotes from JSONL file."""
-        quotes = []
-        with open(quotes_path, 'r', encoding='utf-8') as f:
-            for line in f:
-                line = line.strip()
-                if line:
-                    quotes.append(json.loads(line))
+        if ORJSON_AVAILABLE:
+            # orjson parses UTF-8 bytes directly, so skip text decoding
+            with open(quotes_path, 'rb') as f:
+                quotes = [orjson.loads(line) for line in f if line.strip()]
+        else:
+            quotes = []
+            with open(quotes_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        quotes.append(json.loads(line))
         
         logger.info(f"Loaded {len(quotes)} quotes")
         return quotes
     
-    def prepare_texts(self, quotes: List[Dict]) -> List[str]:
+    def prepare_texts(self, columns: QuoteColumns) -> List[str]:
         """Prepare text for embedding by combining quote text with metadata."""
-        texts = []
-        for quote in quotes:
-            # Combine quote text with author and book for richer embeddings
-            text_parts = [quote['text']]
-            
-            if quote.get('author'):
-                text_parts.append(f"by {quote['author']}")
-            
-            if quote.get('book_title'):
-                text_parts.append(f"from {quote['book_title']}")
-            
-            # Join parts with periods for natural sentence structure
-            full_text = '. '.join(text_parts)
-            texts.append(full_text)
-        
-        return texts
+        # Combine quote text with author and book for richer embeddings,
+        # joined with periods for natural sentence structure
+        return [
+            text + (f". by {author}" if author else '') + (f". from {book}" if book else '')
+            for text, author, book in zip(columns.texts, columns.authors, columns.books)
+        ]
     
-    def compute_embeddings(self, texts: List[str]) -> np.ndarray:
-        """Compute embeddings for all texts."""
-        logger.info("Computing embeddings...")
-        
-        # Process in batches to avoid memory issues
-        batch_size = 32
-        embeddings = []
-        
-        for i in range(0, len(texts), batch_size):
-            batch = texts[i:i + batch_size]
-            batch_embeddings = self.model.encode(batch, show_progress_bar=True)
-            embeddings.append(batch_embeddings)
-            
-            if i % (batch_size * 10) == 0:
-                logger.info(f"Processed {i + len(batch)}/{len(texts)} texts")
+    def compute_embeddings(self, texts: List[str], cache_path: Optional[str] = None) -> np.ndarray:
+        """
+        Compute embeddings for all texts.
+        
+        If cache_path is given, embeddings of texts seen in a previous build
+        (with the same model) are loaded from it and only new texts are
+        encoded. The cache is then rewritten to hold exactly this corpus.
+        """
+        cache = self.load_embedding_cache(cache_path) if cache_path else {}
+        keys, todo = self._plan_embeddings(texts, cache)
+        
+        # Texts that are identical once prepared (e.g. a passage highlighted
+        # twice in the same book) share a key, so each is encoded only once
+        unique_keys = list(dict.fromkeys(keys))
+        if len(unique_keys) < len(keys):
+            logger.info(f"Deduplicated {len(keys)} texts to {len(unique_keys)} unique "
+                        f"({1 - len(unique_keys) / len(keys):.1%} duplicates)")
+        
+        if todo and self.model is None:
+            backend = self.backend
+            self.load_model()
+            if self.backend != backend:
+                # The keys assumed a backend that failed to load
+                keys, todo = self._plan_embeddings(texts, cache)
+                unique_keys = list(dict.fromkeys(keys))
+        
+        if todo:
+            logger.info(f"Computing embeddings for {len(todo)}/{len(unique_keys)} unique texts...")
+            new_embeddings = self._encode(list(todo.values()))
+            for key, embedding in zip(todo, new_embeddings):
+                cache[key] = embedding
+        else:
+            logger.info("All embeddings loaded from cache")
+        
+        embeddings = np.stack([cache[key] for key in keys])
+        
+        # Rewrite when there are new embeddings or stale ones (removed quotes)
+        if cache_path and (todo or len(cache) > len(unique_keys)):
+            self.save_embedding_cache(
+                unique_keys, np.stack([cache[key] for key in unique_keys]), cache_path
+            )
         
-        embeddings = np.vstack(embeddings)
         logger.info(f"Computed embeddings shape: {embeddings.shape}")
         return embeddings
     
-    def find_neighbors(self, embeddings: np.ndarray, quotes: List[Dict]) -> Dict[str, List[str]]:
-        """Find k nearest neighbors for each quote."""
+    def _plan_embeddings(self, texts: List[str], cache: Dict[str, np.ndarray]) -> Tuple[List[str], Dict[str, str]]:
+        """Return each text's cache key and the distinct texts missing from cache, by key."""
+        keys = [self._cache_key(text) for text in texts]
+        todo = {}
+        for key, text in zip(keys, texts):
+            if key not in cache and key not in todo:
+                todo[key] = text
+        return keys, todo
+    
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        """Run the model over texts and return normalized float16 embeddings."""
+        # Pass the whole corpus in one call: SBERT sorts texts by length
+        # before batching (and restores the original order afterwards), so
+        # each batch pads only to similar-length neighbors. Chunking the
+        # input ourselves would limit that sorting to each chunk.
+        if self.device == 'cuda' and torch.cuda.device_count() > 1:
+            # One worker process per GPU, each encoding its share of the corpus
+            logger.info(f"Encoding on {torch.cuda.device_count()} GPUs...")
+            pool = self.model.start_multi_process_pool()
+            try:
+                embeddings = self.model.encode_multi_process(
+                    texts,
+                    pool,
+                    batch_size=self.batch_size,
+                    show_progress_bar=True,
+                    normalize_embeddings=True
+                )
+            finally:
+                self.model.stop_multi_process_pool(pool)
+        else:
+            embeddings = self.model.encode(
+                texts,
+                batch_size=self.batch_size,
+                show_progress_bar=True,
+                convert_to_numpy=True,
+                normalize_embeddings=True
+            )
+        
+        # Normalized SBERT embeddings lose <1e-3 cosine precision in half
+        # precision, and halving the bytes halves the memory traffic of the
+        # similarity search. The search paths upcast where they need to.
+        return embeddings.astype(np.float16)
+    
+    def _cache_key(self, text: str) -> str:
+        """Content hash identifying a text's embedding under this model and backend."""
+        model_id = self.model_name + _BACKEND_CACHE_TAGS[self.backend]
+        return hashlib.blake2b(f"{model_id}|{text}".encode('utf-8'), digest_size=16).hexdigest()
+    
+    def load_embedding_cache(self, cache_path: str) -> Dict[str, np.ndarray]:
+        """Load cached embeddings keyed by content hash."""
+        if not Path(cache_path).exists():
+            return {}
+        
+        try:
+            with np.load(cache_path) as data:
+                cache = dict(zip(data['keys'].tolist(), data['embeddings']))
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable embedding cache {cache_path}: {e}")
+            return {}
+        
+        logger.info(f"Loaded {len(cache)} cached embeddings from: {cache_path}")
+        return cache
+    
+    def save_embedding_cache(self, keys: List[str], embeddings: np.ndarray, cache_path: str):
+        """Save embeddings keyed by content hash."""
+        Path(cache_path).parent.mkdir(parents=True, exist_ok=True)
+        
+        # Keys and vectors as two arrays rather than one archive member per
+        # key, which would make loading large caches slow
+        with open(cache_path, 'wb') as f:
+            np.savez(f, keys=np.array(keys), embeddings=embeddings)
+        
+        logger.info(f"Saved embedding cache to: {cache_path}")
+    
+    def find_neighbors(self, embeddings: np.ndarray) -> np.ndarray:
+        """
+        Find k nearest neighbors for each quote.
+        
+        Returns an (N, k) int32 array of row indices into the corpus, nearest
+        first. Use neighbors_to_ids to map them to quote IDs.
+        """
+        # Never ask for more neighbors than there are other quotes
+        n = len(embeddings)
+        k = min(self.k, n - 1)
+        
+        if self.device == 'cuda':
+            top_indices = self._search_torch(embeddings, k)
+        elif FAISS_AVAILABLE:
+            top_indices = self._search_faiss(embeddings, k)
+        else:
+            top_indices = self._search_exact(embeddings, k)
+        
+        logger.info(f"Found {k} neighbors for each of {n} quotes")
+        return top_indices
+    
+    def neighbors_to_ids(self, top_indices: np.ndarray, ids: List[str]) -> Dict[str, List[str]]:
+        """Map neighbor row indices to a quote ID -> neighbor quote IDs dict."""
+        # Negative entries are padding from an approximate search that came up short
+        return {
+            quote_id: [ids[idx] for idx in row if idx >= 0]
+            for quote_id, row in zip(ids, top_indices.tolist())
+        }
+    
+    def _search_torch(self, embeddings: np.ndarray, k: int) -> np.ndarray:
+        """Find top-k neighbor indices by blocked exact search on the GPU."""
+        logger.info("Computing similarity matrix on GPU...")
+        
+        # Keep half precision on the GPU so the matmul runs on Tensor Cores
+        vectors = torch.from_numpy(np.asarray(embeddings)).to(self.device, dtype=torch.float16)
+        vectors = torch.nn.functional.normalize(vectors, dim=1)
+        
+        blocks = []
+        
+        with torch.no_grad():
+            for start in range(0, len(vectors), GPU_BLOCK_SIZE):
+                sims = torch.mm(vectors[start:start + GPU_BLOCK_SIZE], vectors.T)
+                
+                # Exclude each quote from its own neighbors
+                rows = torch.arange(len(sims), device=sims.device)
+                sims[rows, start + rows] = float('-inf')
+                
+                _, idx = torch.topk(sims, k, dim=1)
+                blocks.append(idx)
+        
+        return torch.cat(blocks).cpu().numpy().astype(np.int32)
+    
+    def _search_faiss(self, embeddings: np.ndarray, k: int) -> np.ndarray:
+        """Find top-k neighbor indices with a FAISS inner-product index."""
+        # Cosine similarity is the inner product of L2-normalized vectors.
+        # FAISS only accepts float32, so upcast a copy.
+        vectors = np.ascontiguousarray(embeddings, dtype=np.float32)
+        faiss.normalize_L2(vectors)
+        
+        n, dim = vectors.shape
+        if n < HNSW_MIN_QUOTES:
+            logger.info("Building exact FAISS index...")
+            index = faiss.IndexFlatIP(dim)
+        else:
+            logger.info("Building FAISS HNSW index...")
+            index = faiss.IndexHNSWFlat(dim, 32, faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efConstruction = 200
+            index.hnsw.efSearch = max(64, 2 * (k + 1))
+        index.add(vectors)
+        
+        # Search one extra neighbor because each quote matches itself
+        _, indices = index.search(vectors, k + 1)
+        
+        # Drop the self-match (usually, but not always, in column 0). Rows
+        # where it was crowded out by exact duplicates drop their last
+        # column instead, so every row keeps exactly k entries. -1 padding
+        # from a short HNSW search is left for neighbors_to_ids to skip.
+        is_self = indices == np.arange(n)[:, None]
+        keep = ~is_self
+        keep[~is_self.any(axis=1), -1] = False
+        
+        return indices[keep].reshape(n, k).astype(np.int32)
+    
+    def _search_exact(self, embeddings: np.ndarray, k: int) -> np.ndarray:
+        """Find top-k neighbor indices by blocked exact cosine similarity."""
         logger.info("Computing similarity matrix...")
         
-        # Compute cosine similarity matrix
-        similarity_matrix = cosine_similarity(embeddings)
+        # Cosine similarity is the dot product of L2-normalized vectors.
+        # NumPy has no BLAS kernel for float16, so upcast once to float32.
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        np.maximum(norms, np.finfo(np.float32).tiny, out=norms)
+        np.divide(vectors, norms, out=vectors)
         
-        neighbors = {}
+        n = len(vectors)
+        result = np.empty((n, k), dtype=np.int32)
+        if k == 0:
+            return result
         
-        for i, quote in enumerate(quotes):
-            # Get similarity scores for this quote
-            similarities = similarity_matrix[i]
+        # Only a (block, N) tile of the similarity matrix exists at a time;
+        # only each row's top-k indices survive into the result
+        for start in range(0, n, SIMILARITY_BLOCK_SIZE):
+            sims = vectors[start:start + SIMILARITY_BLOCK_SIZE] @ vectors.T
+            rows = np.arange(len(sims))
             
-            # Get indices of top-k similar quotes (excluding self)
-            # Add 1 to k because we'll exclude the quote itself
-            top_indices = np.argsort(similarities)[::-1][1:self.k + 1]
+            # Exclude each quote from its own neighbors
+            sims[rows, start + rows] = -np.inf
             
-            # Get the quote IDs of the neighbors
-            neighbor_ids = [quotes[idx]['id'] for idx in top_indices]
-            neighbors[quote['id']] = neighbor_ids
+            if NUMBA_AVAILABLE:
+                result[start:start + len(sims)] = _topk_rows(sims, k)
+            else:
+                # Partial selection of the top k per row, then sort only those
+                top = np.argpartition(sims, -k, axis=1)[:, -k:]
+                top_sims = np.take_along_axis(sims, top, axis=1)
+                order = np.argsort(-top_sims, axis=1)
+                result[start:start + len(sims)] = np.take_along_axis(top, order, axis=1)
         
-        logger.info(f"Found {self.k} neighbors for each of {len(quotes)} quotes")
-        return neighbors
+        return result
     
-    def save_neighbors(self, neighbors: Dict[str, List[str]], output_path: str):
+    def save_neighbors(self, neighbors: Dict[str, List[str]], output_path: str, pretty: bool = False):
         """Save neighbors to JSON file."""
         Path(output_path).parent.mkdir(parents=True, exist_ok=True)
         
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(neighbors, f, indent=2, ensure_ascii=False)
+        _write_json(neighbors, output_path, pretty)
         
         logger.info(f"Saved neighbors to: {output_path}")
     
-    def build_lexical_index(self, quotes: List[Dict]) -> Dict[str, List[str]]:
-        """Build a simple lexical index for keyword-based retrieval."""
-        from collections import defaultdict
-        import re
+    def lexical_postings(self, columns: QuoteColumns) -> Tuple[List[str], List[np.ndarray]]:
+        """
+        Tokenize quotes into an inverted index.
         
-        # Simple word-based index
-        word_to_quotes = defaultdict(set)
+        Returns the indexed terms in sorted order and, for each term, the
+        indices of the quotes containing it in corpus order. Terms found in
+        10% or more of the quotes are dropped as likely stop words.
+        """
+        # Flat (word id, quote index) pairs; sorting by id groups each word's
+        # postings into one contiguous slice without per-pair dict/set work.
+        # Integer ids keep the sort off fixed-width string arrays, which
+        # would pad every token to the longest one.
+        vocab = {}
+        word_ids = []
+        qidx_arr = []
         
-        for quote in quotes:
+        for i, (text, author, book) in enumerate(zip(columns.texts, columns.authors, columns.books)):
             # Extract words from quote text
-            text = quote['text'].lower()
-            words = re.findall(r'\b\w{4,}\b', text)  # Words with 4+ characters
+            words = set(_WORD4.findall(text.lower()))
             
             # Also include author and book words
-            if quote.get('author'):
-                author_words = re.findall(r'\b\w{3,}\b', quote['author'].lower())
-                words.extend(author_words)
+            words.update(_WORD3.findall(f"{author} {book}".lower()))
             
-            if quote.get('book_title'):
-                book_words = re.findall(r'\b\w{3,}\b', quote['book_title'].lower())
-                words.extend(book_words)
-            
-            # Add quote to index for each word
-            for word in set(words):  # Use set to avoid duplicates
-                word_to_quotes[word].add(quote['id'])
-        
-        # Convert sets to lists and filter out very common words
-        lexical_index = {}
-        for word, quote_ids in word_to_quotes.items():
-            quote_list = list(quote_ids)
+            # Each word is added once per quote, so postings stay duplicate-free
+            word_ids.extend([vocab.setdefault(word, len(vocab)) for word in words])
+            qidx_arr.extend([i] * len(words))
+        
+        if not vocab:
+            return [], []
+        
+        # Renumber ids by sorted word so the groups come out in term order
+        sorted_words = sorted(vocab)
+        rank = np.empty(len(vocab), dtype=np.int32)
+        rank[[vocab[word] for word in sorted_words]] = np.arange(len(vocab), dtype=np.int32)
+        w = rank[np.asarray(word_ids, dtype=np.int32)]
+        q = np.asarray(qidx_arr, dtype=np.int32)
+        
+        # Stable sort keeps each word's quotes in corpus order
+        order = np.argsort(w, kind='stable')
+        q = q[order]
+        
+        # Every vocabulary word occurs at least once, so the groups are the
+        # cumulative counts of each rank
+        ends = np.cumsum(np.bincount(w, minlength=len(vocab)))
+        starts = np.concatenate(([0], ends[:-1]))
+        
+        # Filter out very common words
+        max_quotes = len(columns.ids) * 0.1  # Less than 10% of quotes
+        terms = []
+        postings = []
+        
+        for word, start, end in zip(sorted_words, starts.tolist(), ends.tolist()):
             # Skip words that appear in too many quotes (likely stop words)
-            if len(quote_list) < len(quotes) * 0.1:  # Less than 10% of quotes
-                lexical_index[word] = quote_list
+            if end - start < max_quotes:
+                terms.append(word)
+                postings.append(q[start:end])
+        
+        return terms, postings
+    
+    def build_lexical_index(self, columns: QuoteColumns,
+                            postings: Optional[Tuple[List[str], List[np.ndarray]]] = None) -> Dict[str, List[str]]:
+        """Build a simple lexical index for keyword-based retrieval."""
+        terms, quote_indices = postings if postings is not None else self.lexical_postings(columns)
+        
+        ids = columns.ids
+        lexical_index = {
+            term: [ids[j] for j in indices.tolist()]
+            for term, indices in zip(terms, quote_indices)
+        }
         
         logger.info(f"Built lexical index with {len(lexical_index)} terms")
         return lexical_index
     
-    def save_lexical_index(self, index: Dict[str, List[str]], output_path: str):
+    def save_lexical_index(self, index: Dict[str, List[str]], output_path: str, pretty: bool = False):
         """Save lexical index to JSON file."""
         base_path = Path(output_path)
         index_path = base_path.parent / (base_path.stem + '_lexical.json')
         
-        with open(index_path, 'w', encoding='utf-8') as f:
-            json.dump(index, f, indent=2, ensure_ascii=False)
+        _write_json(index, index_path, pretty)
         
         logger.info(f"Saved lexical index to: {index_path}")
     
+    def build_lexical_matrix(self, columns: QuoteColumns,
+                             postings: Optional[Tuple[List[str], List[np.ndarray]]] = None):
+        """
+        Build a TF-IDF weighted quote-by-term sparse matrix.
+        
+        Rows follow corpus order and columns the order of the
+        returned terms. Rows are L2-normalized, so a lexical query is one
+        sparse matrix-vector product instead of a loop over the JSON index.
+        """
+        terms, quote_indices = postings if postings is not None else self.lexical_postings(columns)
+        n_quotes = len(columns.ids)
+        
+        # Postings are per-term columns, so they form a CSC matrix directly
+        indptr = np.zeros(len(terms) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(indices) for indices in quote_indices])
+        rows = np.concatenate(quote_indices) if quote_indices else np.empty(0, dtype=np.int32)
+        
+        # Binary term frequency with smoothed IDF, as TfidfVectorizer(binary=True)
+        df = np.diff(indptr)
+        idf = (np.log((1 + n_quotes) / (1 + df)) + 1).astype(np.float32)
+        data = np.repeat(idf, df)
+        
+        matrix = sparse.csc_matrix((data, rows, indptr), shape=(n_quotes, len(terms))).tocsr()
+        
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        matrix = sparse.diags(1 / norms).dot(matrix).tocsr().astype(np.float32)
+        
+        logger.info(f"Built lexical matrix with shape {matrix.shape} and {matrix.nnz} entries")
+        return matrix, terms
+    
+    def save_lexical_matrix(self, matrix, terms: List[str], ids: List[str], output_path: str):
+        """Save the lexical matrix as .npz plus a JSON file of row and column labels."""
+        base_path = Path(output_path)
+        matrix_path = base_path.parent / (base_path.stem + '_lexical.npz')
+        labels_path = base_path.parent / (base_path.stem + '_lexical_labels.json')
+        
+        sparse.save_npz(matrix_path, matrix)
+        _write_json({'quote_ids': ids, 'terms': terms}, labels_path)
+        
+        logger.info(f"Saved lexical matrix to: {matrix_path}")
+    
     def print_sample_neighbors(self, quotes: List[Dict], neighbors: Dict[str, List[str]], n: int = 3):
         """Print sample neighbors for inspection."""
         logger.info(f"\nSample neighbors (showing {n} examples):")
@@ -208,7 +663,8 @@ class GraphBuilder:
                     print(f"  {j+1}. \"{neighbor['text'][:80]}...\"")
                     print(f"     ({neighbor.get('author', 'Unknown')} - {neighbor.get('book_title', 'Unknown')})")
     
-    def build(self, quotes_path: str, output_path: str, build_lexical: bool = True):
+    def build(self, quotes_path: str, output_path: str, build_lexical: bool = True,
+              use_cache: bool = True, pretty: bool = False):
         """Main build process."""
         # Load quotes
         quotes = self.load_quotes(quotes_path)
@@ -216,23 +672,32 @@ class GraphBuilder:
         if len(quotes) == 0:
             raise ValueError("No quotes found in input file")
         
-        # Load model
-        self.load_model()
-        
-        # Prepare texts and compute embeddings
-        texts = self.prepare_texts(quotes)
-        embeddings = self.compute_embeddings(texts)
+        # Prepare texts and compute embeddings (the model is loaded only if
+        # some texts are missing from the cache)
+        columns = _columnize(quotes)
+        texts = self.prepare_texts(columns)
+        cache_path = None
+        if use_cache:
+            base_path = Path(output_path)
+            cache_path = str(base_path.parent / (base_path.stem + '_embeddings.npz'))
+        embeddings = self.compute_embeddings(texts, cache_path)
         
         # Find neighbors
-        neighbors = self.find_neighbors(embeddings, quotes)
+        top_indices = self.find_neighbors(embeddings)
+        neighbors = self.neighbors_to_ids(top_indices, columns.ids)
         
         # Save neighbors
-        self.save_neighbors(neighbors, output_path)
+        self.save_neighbors(neighbors, output_path, pretty)
         
         # Build and save lexical index if requested
         if build_lexical:
-            lexical_index = self.build_lexical_index(quotes)
-            self.save_lexical_index(lexical_index, output_path)
+            postings = self.lexical_postings(columns)
+            lexical_index = self.build_lexical_index(columns, postings)
+            self.save_lexical_index(lexical_index, output_path, pretty)
+            
+            if SCIPY_AVAILABLE:
+                matrix, terms = self.build_lexical_matrix(columns, postings)
+                self.save_lexical_matrix(matrix, terms, columns.ids, output_path)
         
         # Print sample results
         self.print_sample_neighbors(quotes, neighbors)
@@ -249,6 +714,16 @@ def main():
                        help='Sentence transformer model to use (default: all-MiniLM-L6-v2)')
     parser.add_argument('--no-lexical', action='store_true', 
                        help='Skip building lexical index')
+    parser.add_argument('--quantize', action='store_true',
+                       help='Use int8-quantized ONNX weights on CPU (requires onnxruntime)')
+    parser.add_argument('--batch-size', type=int, default=None,
+                       help='Texts per embedding batch (default: 256 on GPU, 64 on CPU)')
+    parser.add_argument('--no-cache', action='store_true',
+                       help='Recompute all embeddings instead of reusing cached ones')
+    parser.add_argument('--pretty', action='store_true',
+                       help='Indent the output JSON for human reading')
+    parser.add_argument('--compile', action='store_true',
+                       help='Compile the model with torch.compile (single GPU only)')
     
     args = parser.parse_args()
     
@@ -257,8 +732,10 @@ def main():
         return 1
     
     try:
-        builder = GraphBuilder(model_name=args.model, k=args.k)
-        builder.build(args.quotes_file, args.output_file, build_lexical=not args.no_lexical)
+        builder = GraphBuilder(model_name=args.model, k=args.k, quantize=args.quantize,
+                               batch_size=args.batch_size, compile_model=args.compile)
+        builder.build(args.quotes_file, args.output_file, build_lexical=not args.no_lexical,
+                      use_cache=not args.no_cache, pretty=args.pretty)
         return 0
     
     except ImportError as e:
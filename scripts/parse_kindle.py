@@ -24,8 +24,59 @@ from datetime import datetime
 from pathlib import Path
 from typing import List, Dict, Optional
 
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+try:
+    from dateutil import parser as date_parser
+    DATEUTIL_AVAILABLE = True
+except ImportError:
+    DATEUTIL_AVAILABLE = False
+
 
 class KindleParser:
+    # Map common column names (case-insensitive), in order of preference
+    COLUMN_MAPPING = {
+        'highlight': ['highlight', 'text', 'quote', 'content'],
+        'book_title': ['book title', 'title', 'book', 'book_title'],
+        'author': ['book author', 'author', 'book_author'],
+        'location': ['location'],
+        'note': ['note', 'notes'],
+        'color': ['color', 'colour'],
+        'tags': ['tags', 'tag'],
+        'location_type': ['location type', 'location_type'],
+        'highlighted_at': ['highlighted at', 'highlighted_at', 'date', 'timestamp'],
+        'amazon_id': ['amazon book id', 'amazon_book_id', 'book_id', 'id']
+    }
+    
+    _LOC_RE = re.compile(r'(\d+)')
+    _TAG_RE = re.compile(r'[,;|]')
+    
+    # Date formats seen in Kindle exports, matched without strptime
+    _WEEKDAY_RE = re.compile(r'^(Monday|Tuesday|Wednesday|Thursday|Friday|Saturday|Sunday),?\s*')
+    _TIME_12H = r'(?:\s+(?P<hour>\d{1,2}):(?P<minute>\d{1,2}):(?P<second>\d{1,2})\s*(?P<ampm>[AaPp][Mm]))?'
+    _DATE_PATTERNS = [
+        # January 1, 2024 12:00:00 PM / January 1, 2024
+        re.compile(r'(?P<month>[A-Za-z]+)\s+(?P<day>\d{1,2}),\s+(?P<year>\d{4})' + _TIME_12H),
+        # 1/1/2024 12:00:00 PM / 1/1/2024
+        re.compile(r'(?P<month>\d{1,2})/(?P<day>\d{1,2})/(?P<year>\d{4})' + _TIME_12H),
+        # 2024-01-01 12:00:00 / 2024-01-01
+        re.compile(r'(?P<year>\d{4})-(?P<month>\d{1,2})-(?P<day>\d{1,2})'
+                   r'(?:\s+(?P<hour>\d{1,2}):(?P<minute>\d{1,2}):(?P<second>\d{1,2}))?'),
+    ]
+    _MONTHS = {
+        name: number for number, name in enumerate(
+            ['january', 'february', 'march', 'april', 'may', 'june', 'july',
+             'august', 'september', 'october', 'november', 'december'], 1)
+    }
+    
+    # dateutil fills unparsed fields from its default; parsing with two
+    # defaults that differ in year, month and day exposes which were missing
+    _DATEUTIL_DEFAULTS = (datetime(2000, 1, 1), datetime(2001, 2, 2))
+    
     def __init__(self):
         self.quote_id_counter = 0
         
@@ -41,19 +92,9 @@ class KindleParser:
     
     def parse_txt_file(self, input_path: str) -> List[Dict]:
         """Parse standard Kindle TXT file."""
-        try:
-            with open(input_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-        except UnicodeDecodeError:
-            # Try with different encoding if UTF-8 fails
-            with open(input_path, 'r', encoding='latin-1') as f:
-                content = f.read()
-        
-        # Split by the separator line that Kindle uses
-        sections = content.split('==========')
         quotes = []
         
-        for section in sections:
+        for section in self._iter_sections(input_path):
             section = section.strip()
             if not section:
                 continue
@@ -64,6 +105,31 @@ class KindleParser:
         
         return quotes
     
+    def _iter_sections(self, input_path: str):
+        """Yield the highlight sections of a Kindle TXT file one at a time."""
+        # Read line by line and split on the separator line that Kindle uses,
+        # so only one section is held in memory instead of the whole file
+        buf = []
+        with open(input_path, 'rb') as f:
+            for line in f:
+                if line.rstrip() == b'==========':
+                    if buf:
+                        yield self._decode_section(b''.join(buf))
+                        buf = []
+                else:
+                    buf.append(line)
+        
+        if buf:
+            yield self._decode_section(b''.join(buf))
+    
+    def _decode_section(self, data: bytes) -> str:
+        """Decode a section as UTF-8, falling back to Latin-1."""
+        try:
+            return data.decode('utf-8')
+        except UnicodeDecodeError:
+            # Try with different encoding if UTF-8 fails
+            return data.decode('latin-1')
+    
     def parse_csv_file(self, input_path: str) -> List[Dict]:
         """Parse CSV file with Kindle highlights."""
         quotes = []
@@ -83,8 +149,11 @@ class KindleParser:
                 
                 reader = csv.DictReader(f, delimiter=delimiter)
                 
+                # The header is fixed for the file, so match columns once
+                columns = self.resolve_columns(reader.fieldnames)
+                
                 for row_num, row in enumerate(reader, 1):
-                    quote = self.parse_csv_row(row, row_num)
+                    quote = self.parse_csv_row(row, row_num, columns)
                     if quote:
                         quotes.append(quote)
                         
@@ -93,31 +162,31 @@ class KindleParser:
         
         return quotes
     
-    def parse_csv_row(self, row: Dict[str, str], row_num: int) -> Optional[Dict]:
-        """Parse a single CSV row into a quote dictionary."""
-        # Map common column names (case-insensitive)
-        column_mapping = {
-            'highlight': ['highlight', 'text', 'quote', 'content'],
-            'book_title': ['book title', 'title', 'book', 'book_title'],
-            'author': ['book author', 'author', 'book_author'],
-            'location': ['location'],
-            'note': ['note', 'notes'],
-            'color': ['color', 'colour'],
-            'tags': ['tags', 'tag'],
-            'location_type': ['location type', 'location_type'],
-            'highlighted_at': ['highlighted at', 'highlighted_at', 'date', 'timestamp'],
-            'amazon_id': ['amazon book id', 'amazon_book_id', 'book_id', 'id']
-        }
-        
+    def resolve_columns(self, fieldnames: Optional[List[str]]) -> Dict[str, List[str]]:
+        """Map each field to the matching CSV header columns, in preference order."""
         # Create case-insensitive lookup
-        row_lower = {k.lower().strip(): v.strip() for k, v in row.items() if v}
+        header = {}
+        for name in fieldnames or []:
+            if name is not None:
+                header[name.lower().strip()] = name
+        
+        return {
+            field: [header[name] for name in possible_names if name in header]
+            for field, possible_names in self.COLUMN_MAPPING.items()
+        }
+    
+    def parse_csv_row(self, row: Dict[str, str], row_num: int,
+                      columns: Optional[Dict[str, List[str]]] = None) -> Optional[Dict]:
+        """Parse a single CSV row into a quote dictionary."""
+        if columns is None:
+            columns = self.resolve_columns(list(row))
         
         def find_column_value(field_name: str) -> str:
-            """Find value for a field using flexible column matching."""
-            possible_names = column_mapping.get(field_name, [field_name])
-            for name in possible_names:
-                if name in row_lower:
-                    return row_lower[name]
+            """Find value for a field using the resolved column matching."""
+            for column in columns.get(field_name, ()):
+                value = row.get(column)
+                if value:
+                    return value.strip()
             return ''
         
         # Extract the highlight text
@@ -143,7 +212,7 @@ class KindleParser:
                 parsed_location = int(location)
             except ValueError:
                 # Try to extract number from location string
-                location_match = re.search(r'(\d+)', location)
+                location_match = self._LOC_RE.search(location)
                 if location_match:
                     parsed_location = int(location_match.group(1))
         
@@ -151,7 +220,7 @@ class KindleParser:
         parsed_tags = []
         if tags:
             # Split by common separators
-            tag_list = re.split(r'[,;|]', tags)
+            tag_list = self._TAG_RE.split(tags)
             parsed_tags = [tag.strip() for tag in tag_list if tag.strip()]
         
         # Parse timestamp
@@ -268,35 +337,66 @@ class KindleParser:
     def normalize_date(self, date_str: str) -> str:
         """Normalize various date formats to ISO format."""
         # Remove day of week if present
-        date_str = re.sub(r'^(Monday|Tuesday|Wednesday|Thursday|Friday|Saturday|Sunday),?\s*', '', date_str)
-        
-        # Common patterns to try
-        patterns = [
-            '%B %d, %Y %I:%M:%S %p',  # January 1, 2024 12:00:00 PM
-            '%B %d, %Y',              # January 1, 2024
-            '%m/%d/%Y %I:%M:%S %p',   # 1/1/2024 12:00:00 PM
-            '%m/%d/%Y',               # 1/1/2024
-            '%Y-%m-%d %H:%M:%S',      # 2024-01-01 12:00:00
-            '%Y-%m-%d',               # 2024-01-01
-        ]
-        
-        for pattern in patterns:
+        date_str = self._WEEKDAY_RE.sub('', date_str)
+        
+        for pattern in self._DATE_PATTERNS:
+            match = pattern.fullmatch(date_str)
+            if match:
+                dt = self._build_date(match.groupdict())
+                if dt:
+                    return dt.isoformat()
+        
+        # Fall back to dateutil for formats not listed above, keeping only
+        # full dates rather than ones completed from the defaults
+        if DATEUTIL_AVAILABLE:
             try:
-                dt = datetime.strptime(date_str, pattern)
-                return dt.isoformat()
-            except ValueError:
-                continue
+                first, second = (date_parser.parse(date_str, default=default)
+                                 for default in self._DATEUTIL_DEFAULTS)
+            except (ValueError, OverflowError):
+                pass
+            else:
+                if first.date() == second.date():
+                    return first.isoformat()
         
         # If no pattern matches, return the original string
         return date_str
     
+    def _build_date(self, parts: Dict[str, Optional[str]]) -> Optional[datetime]:
+        """Build a datetime from regex groups, or None if they are out of range."""
+        month = parts['month']
+        month = int(month) if month.isdigit() else self._MONTHS.get(month.lower())
+        if month is None:
+            return None
+        
+        hour = int(parts['hour']) if parts['hour'] else 0
+        ampm = parts.get('ampm')
+        if ampm:
+            # 12-hour clock: 12 AM is midnight, 12 PM is noon
+            if not 1 <= hour <= 12:
+                return None
+            hour = hour % 12 + (12 if ampm.upper() == 'PM' else 0)
+        
+        try:
+            return datetime(
+                int(parts['year']), month, int(parts['day']), hour,
+                int(parts['minute'] or 0), int(parts['second'] or 0)
+            )
+        except ValueError:
+            return None
+    
     def save_jsonl(self, quotes: List[Dict], output_path: str):
         """Save quotes to JSONL format."""
         Path(output_path).parent.mkdir(parents=True, exist_ok=True)
         
-        with open(output_path, 'w', encoding='utf-8') as f:
-            for quote in quotes:
-                f.write(json.dumps(quote, ensure_ascii=False) + '\n')
+        if ORJSON_AVAILABLE:
+            # orjson emits UTF-8 bytes without escaping non-ASCII characters
+            with open(output_path, 'wb') as f:
+                for quote in quotes:
+                    f.write(orjson.dumps(quote) + b'\n')
+        else:
+            with open(output_path, 'w', encoding='utf-8') as f:
+                for quote in quotes:
+                    f.write(json.dumps(quote, ensure_ascii=False) + '\n')
     
     def print_stats(self, quotes: List[Dict]):
         """Print parsing statistics."""
@@ -1,37 +1,278 @@
 #!/usr/bin/env python3
 """
 Test script to verify Mapkeeper setup
+
+Usage:
+    python test_setup.py
+    python test_setup.py --fail-fast    # stop at the first failed check
+    python test_setup.py --no-cache     # re-validate data files even if unchanged
 """
 
+import functools
+import hashlib
+import io
 import json
+import mmap
+import os
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+try:
+    # orjson.JSONDecodeError subclasses json.JSONDecodeError, so the
+    # handlers below catch errors from either parser
+    from orjson import loads as _loads
+    _JSON_BACKEND = 'orjson'
+except ImportError:
+    _JSON_BACKEND = 'json'
+    
+    # One decoder bound once; calling its decode directly skips the
+    # argument and encoding checks json.loads repeats on every line
+    _decode = json.JSONDecoder().decode
+    
+    def _loads(data):
+        """Parse UTF-8 JSON bytes with the shared decoder"""
+        return _decode(data.decode('utf-8'))
+
+# Repository locations, resolved once at import
+_HERE = Path(__file__).resolve().parent
+_ROOT = _HERE.parent
+_DATA = _ROOT / 'data'
+_PUBLIC = _ROOT / 'public'
+_FUNCTIONS = _ROOT / 'functions'
+_CACHE_PATH = _ROOT / '.mapkeeper_test_cache.json'
+
+# Largest quotes.jsonl parsed in one batch rather than streamed line by line
+_BATCH_MAX_BYTES = 64 * 1024 * 1024
+
+# Fields every quote record must have
+_REQUIRED_FIELDS = ('id', 'text', 'author', 'book_title', 'source')
+
+def _compile_field_check(fields):
+    """Generate a straight-line function returning the fields missing from a record"""
+    src = "def _check(q):\n    missing = ()\n"
+    src += "".join(f"    if {field!r} not in q: missing += ({field!r},)\n" for field in fields)
+    src += "    return missing\n"
+    namespace = {}
+    exec(src, namespace)
+    return namespace['_check']
+
+# One explicit membership test per field, no loop or set construction
+_check_quote = _compile_field_check(_REQUIRED_FIELDS)
+
+QUOTE_SCHEMA = {
+    "type": "object",
+    "required": list(_REQUIRED_FIELDS),
+    "properties": {field: {"type": "string"} for field in _REQUIRED_FIELDS},
+}
+
+try:
+    # Event-stream parser for validating neighbors.json without building it
+    import ijson
+    _JSON_ERRORS = (json.JSONDecodeError, ijson.JSONError)
+except ImportError:
+    ijson = None
+    _JSON_ERRORS = (json.JSONDecodeError,)
+
+try:
+    # Compiled once into specialized Python code; also checks field types
+    import fastjsonschema
+    _validate_quote = fastjsonschema.compile(QUOTE_SCHEMA)
+except ImportError:
+    _validate_quote = None
+
+class _ThreadLocalStdout:
+    """Stand-in for sys.stdout that gives each capturing thread its own buffer"""
+    
+    def __init__(self, default):
+        self._default = default
+        self._local = threading.local()
+    
+    def capture(self, func):
+        """Run func with this thread's output buffered; return (result, output)"""
+        self._local.buffer = io.StringIO()
+        try:
+            return func(), self._local.buffer.getvalue()
+        finally:
+            del self._local.buffer
+    
+    def write(self, text):
+        return getattr(self._local, 'buffer', self._default).write(text)
+    
+    def flush(self):
+        getattr(self._local, 'buffer', self._default).flush()
+
+def _validator_fingerprint():
+    """Hash identifying the checks in effect: schema, fields, parsers, validators and this script"""
+    # The parsers differ in what they accept (json takes NaN, orjson does not)
+    h = hashlib.blake2b(digest_size=8)
+    h.update(json.dumps([QUOTE_SCHEMA, _REQUIRED_FIELDS, _JSON_BACKEND,
+                         _validate_quote is not None, ijson is not None],
+                        sort_keys=True).encode('utf-8'))
+    h.update(Path(__file__).read_bytes())
+    return h.hexdigest()
+
+class _ResultCache:
+    """Data-file check results keyed by file (size, mtime_ns) and validator fingerprints"""
+    
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._dirty = False
+        # A pass under looser or older checks says nothing about the current ones
+        self._validator = _validator_fingerprint()
+        try:
+            entries = json.loads(path.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            entries = {}
+        self._entries = entries if isinstance(entries, dict) else {}
+    
+    def _key(self, file_path):
+        return os.path.relpath(file_path, self._path.parent)
+    
+    def passed(self, file_path, fingerprint):
+        """True if the file passed its last check and has not changed since"""
+        return self._entries.get(self._key(file_path)) == [*fingerprint, self._validator, True]
+    
+    def record(self, file_path, fingerprint, ok):
+        with self._lock:
+            self._entries[self._key(file_path)] = [*fingerprint, self._validator, ok]
+            self._dirty = True
+    
+    def save(self):
+        if not self._dirty:
+            return
+        try:
+            self._path.write_text(json.dumps(self._entries), encoding='utf-8')
+        except OSError as e:
+            print(f"⚠️  Could not write {self._path.name}: {e}")
+
+# Set by main(); None disables caching, e.g. when a test is called directly
+_cache = None
+
+def _cached_check(path):
+    """Skip a data-file check when the file is unchanged since it last passed"""
+    def decorator(check):
+        @functools.wraps(check)
+        def wrapper():
+            if _cache is None:
+                return check()
+            try:
+                st = os.stat(path)
+            except OSError:
+                return check()
+            # Fingerprint taken before the check, so edits made while it
+            # runs invalidate the entry on the next run
+            fingerprint = (st.st_size, st.st_mtime_ns)
+            if _cache.passed(path, fingerprint):
+                print(f"✅ {path.name} valid (unchanged since last check)")
+                return True
+            ok = check()
+            _cache.record(path, fingerprint, ok)
+            return ok
+        return wrapper
+    return decorator
+
+def _list_dir(path):
+    """Names in a directory from a single scandir, or an empty set if it can't be listed"""
+    # Missing, not a directory, or unreadable: its files all count as missing
+    try:
+        with os.scandir(path) as entries:
+            return {entry.name for entry in entries}
+    except OSError:
+        return set()
+
+def _iter_lines(path):
+    """Yield a file's lines as bytes, finding newlines in a memory map"""
+    with open(path, 'rb') as f:
+        # mmap rejects empty files
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = 0
+            end = len(mm)
+            while start < end:
+                stop = mm.find(b'\n', start)
+                if stop == -1:
+                    stop = end
+                yield mm[start:stop]
+                start = stop + 1
+
+def _quote_error(quote, line_num):
+    """Describe what is wrong with a quote record, or return None if it is valid"""
+    if _validate_quote is not None:
+        try:
+            _validate_quote(quote)
+        except fastjsonschema.JsonSchemaException as e:
+            return f"❌ Invalid quote {line_num}: {e.message}"
+        return None
+    
+    missing = _check_quote(quote)
+    if missing:
+        names = ", ".join(f"'{field}'" for field in missing)
+        label = "field" if len(missing) == 1 else "fields"
+        return f"❌ Missing {label} {names} in quote {line_num}"
+    return None
+
+def _has_content(line):
+    """Whether a line holds anything besides whitespace"""
+    # Records start with '{', so only other lines pay for a strip() copy
+    return line.startswith(b'{') or bool(line.strip())
+
+def _load_quotes_batch(quotes_path):
+    """Parse every quote with one loads call, or return None if that fails"""
+    # The batch holds the whole file several times over; larger files go
+    # straight to the streaming scan, whose memory use stays flat
+    if quotes_path.stat().st_size > _BATCH_MAX_BYTES:
+        return None
+    
+    # Splice the lines into a single JSON array so the parser crosses into
+    # C once for the whole file rather than once per line. Each line gets
+    # its own brackets, so a value spanning lines fails to parse and a line
+    # holding several values shows up as a longer sub-list
+    try:
+        lines = [line for line in quotes_path.read_bytes().split(b'\n') if _has_content(line)]
+        wrapped = _loads(b'[[' + b'],['.join(lines) + b']]') if lines else []
+    except (json.JSONDecodeError, MemoryError):
+        return None
+    
+    # A line holding '],[' would split into two one-item sub-lists
+    if len(wrapped) != len(lines) or any(len(items) != 1 for items in wrapped):
+        return None
+    return [items[0] for items in wrapped]
+
+@_cached_check(_DATA / 'quotes.jsonl')
 def test_quotes_file():
     """Test that quotes.jsonl is valid"""
-    quotes_path = Path(__file__).parent.parent / 'data' / 'quotes.jsonl'
+    quotes_path = _DATA / 'quotes.jsonl'
     
     if not quotes_path.exists():
         print("❌ quotes.jsonl not found")
         return False
     
     try:
-        quotes = []
-        with open(quotes_path, 'r') as f:
-            for line_num, line in enumerate(f, 1):
-                line = line.strip()
-                if line:
-                    quote = json.loads(line)
-                    quotes.append(quote)
-                    
-                    # Validate required fields
-                    required_fields = ['id', 'text', 'author', 'book_title', 'source']
-                    for field in required_fields:
-                        if field not in quote:
-                            print(f"❌ Missing field '{field}' in quote {line_num}")
-                            return False
+        # Fast path for the common case of a valid file
+        quotes = _load_quotes_batch(quotes_path)
+        if quotes is not None and all(_quote_error(quote, 0) is None for quote in quotes):
+            print(f"✅ quotes.jsonl valid ({len(quotes)} quotes)")
+            return True
+        quotes = None  # Release the batch before re-scanning
         
-        print(f"✅ quotes.jsonl valid ({len(quotes)} quotes)")
+        # Otherwise re-scan line by line to report where the problem is
+        count = 0
+        for line_num, line in enumerate(_iter_lines(quotes_path), 1):
+            if _has_content(line):
+                quote = _loads(line)
+                count += 1
+                
+                # Validate required fields
+                error = _quote_error(quote, line_num)
+                if error:
+                    print(error)
+                    return False
+        
+        print(f"✅ quotes.jsonl valid ({count} quotes)")
         return True
         
     except json.JSONDecodeError as e:
@@ -41,77 +282,107 @@ def test_quotes_file():
         print(f"❌ Error reading quotes.jsonl: {e}")
         return False
 
+@_cached_check(_DATA / 'neighbors.json')
 def test_neighbors_file():
     """Test that neighbors.json is valid"""
-    neighbors_path = Path(__file__).parent.parent / 'data' / 'neighbors.json'
+    neighbors_path = _DATA / 'neighbors.json'
     
     if not neighbors_path.exists():
         print("❌ neighbors.json not found")
         return False
     
     try:
-        with open(neighbors_path, 'r') as f:
-            neighbors = json.load(f)
+        if ijson is not None:
+            return _check_neighbors_stream(neighbors_path)
+        
+        with open(neighbors_path, 'rb') as f:
+            neighbors = _loads(f.read())
         
         if not isinstance(neighbors, dict):
             print("❌ neighbors.json should be a dictionary")
             return False
         
-        # Check that all values are lists
-        for quote_id, neighbor_list in neighbors.items():
-            if not isinstance(neighbor_list, list):
-                print(f"❌ Neighbors for {quote_id} should be a list")
-                return False
+        # Check that all values are lists, stopping at the first that isn't
+        bad = next((quote_id for quote_id, neighbor_list in neighbors.items()
+                    if type(neighbor_list) is not list), None)
+        if bad is not None:
+            print(f"❌ Neighbors for {bad} should be a list")
+            return False
         
         print(f"✅ neighbors.json valid ({len(neighbors)} quote mappings)")
         return True
         
-    except json.JSONDecodeError as e:
+    except _JSON_ERRORS as e:
         print(f"❌ Invalid JSON in neighbors.json: {e}")
         return False
     except Exception as e:
         print(f"❌ Error reading neighbors.json: {e}")
         return False
 
+def _check_neighbors_stream(neighbors_path):
+    """Validate neighbors.json one mapping at a time, keeping only a counter"""
+    with open(neighbors_path, 'rb') as f:
+        events = ijson.parse(f)
+        
+        _, event, _ = next(events)
+        if event != 'start_map':
+            print("❌ neighbors.json should be a dictionary")
+            return False
+        
+        # Only one neighbor list is materialized at a time
+        count = 0
+        for quote_id, neighbor_list in ijson.kvitems(events, ''):
+            if type(neighbor_list) is not list:
+                print(f"❌ Neighbors for {quote_id} should be a list")
+                return False
+            count += 1
+    
+    print(f"✅ neighbors.json valid ({count} quote mappings)")
+    return True
+
 def test_static_files():
     """Test that static files exist"""
-    public_path = Path(__file__).parent.parent / 'public'
+    public_path = _PUBLIC
     
     required_files = ['index.html', 'styles.css', 'app.js']
+    existing = _list_dir(public_path)
     all_exist = True
+    msgs = []
     
     for filename in required_files:
-        file_path = public_path / filename
-        if file_path.exists():
-            print(f"✅ {filename} exists")
+        if filename in existing:
+            msgs.append(f"✅ {filename} exists")
         else:
-            print(f"❌ {filename} missing")
+            msgs.append(f"❌ {filename} missing")
             all_exist = False
     
+    # One write for the whole report rather than one per file
+    sys.stdout.write("\n".join(msgs) + "\n")
     return all_exist
 
 def test_scripts():
     """Test that scripts exist and are executable"""
-    scripts_path = Path(__file__).parent
+    scripts_path = _HERE
     
     required_scripts = ['parse_kindle.py', 'build_graph.py']
+    existing = _list_dir(scripts_path)
     all_exist = True
+    msgs = []
     
     for script_name in required_scripts:
-        script_path = scripts_path / script_name
-        if script_path.exists():
-            print(f"✅ {script_name} exists")
+        if script_name in existing:
+            msgs.append(f"✅ {script_name} exists")
         else:
-            print(f"❌ {script_name} missing")
+            msgs.append(f"❌ {script_name} missing")
             all_exist = False
     
+    # One write for the whole report rather than one per file
+    sys.stdout.write("\n".join(msgs) + "\n")
     return all_exist
 
 def test_functions():
     """Test that serverless function exists"""
-    functions_path = Path(__file__).parent.parent / 'functions' / 'mapkeeper.js'
-    
-    if functions_path.exists():
+    if 'mapkeeper.js' in _list_dir(_FUNCTIONS):
         print("✅ mapkeeper.js function exists")
         return True
     else:
@@ -119,25 +390,63 @@ def test_functions():
         return False
 
 def main():
+    global _cache
+    args = sys.argv[1:]
+    fail_fast = '--fail-fast' in args
+    if '--no-cache' not in args:
+        _cache = _ResultCache(_CACHE_PATH)
+    
     print("🧪 Testing Mapkeeper setup...\n")
     
+    # Cheapest first: existence checks before parsing the data files
     tests = [
         ("Static files", test_static_files),
         ("Scripts", test_scripts),
+        ("Serverless function", test_functions),
         ("Quotes data", test_quotes_file),
         ("Neighbors data", test_neighbors_file),
-        ("Serverless function", test_functions),
     ]
     
     passed = 0
     total = len(tests)
+    stopped = False
     
-    for test_name, test_func in tests:
-        print(f"\n📋 Testing {test_name}:")
-        if test_func():
+    if fail_fast:
+        # Run in order and stop before parsing anything once a check fails
+        for test_name, test_func in tests:
+            print(f"\n📋 Testing {test_name}:")
+            if not test_func():
+                print(f"   Failed {test_name}")
+                stopped = True
+                break
             passed += 1
-        else:
-            print(f"   Failed {test_name}")
+    else:
+        # The tests are independent, so run them concurrently to overlap their
+        # file I/O, buffering each one's output so reports print in order
+        stdout = sys.stdout
+        router = _ThreadLocalStdout(stdout)
+        sys.stdout = router
+        try:
+            with ThreadPoolExecutor(max_workers=total) as executor:
+                futures = [executor.submit(router.capture, test_func) for _, test_func in tests]
+                results = [future.result() for future in futures]
+        finally:
+            sys.stdout = stdout
+        
+        for (test_name, _), (ok, output) in zip(tests, results):
+            print(f"\n📋 Testing {test_name}:")
+            sys.stdout.write(output)
+            if ok:
+                passed += 1
+            else:
+                print(f"   Failed {test_name}")
+    
+    if _cache is not None:
+        _cache.save()
+    
+    if stopped:
+        print(f"\n❌ Stopped after {passed + 1}/{total} tests (--fail-fast). Please fix the issues above.")
+        return 1
     
     print(f"\n🎯 Results: {passed}/{total} tests passed")
     